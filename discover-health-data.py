@@ -8,18 +8,49 @@ and tries multiple methods to retrieve your Samsung Health data.
 
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-import pickle
 
 try:
     import requests
     from google.oauth2.credentials import Credentials
-    from google_auth_oauthlib.flow import InstalledAppFlow
-    from google.auth.transport.requests import Request
 except ImportError:
     print("Missing dependencies. Run: pip install -r requirements.txt")
     exit(1)
 
+from health_common import FITNESS_API_URL, REQUEST_TIMEOUT, create_api_session
+
+
+@contextmanager
+def buffered_output():
+    """Collect a probe's output lines and print them as one block on exit
+
+    Probes run concurrently, so each report is written in one piece instead of
+    interleaving with the others line by line.
+    """
+    lines = []
+    try:
+        yield lines.append
+    finally:
+        print("\n".join(lines))
+
+
+def json_preview(data, limit: int) -> str:
+    """Return the first `limit` characters of data as indented JSON
+
+    Encodes lazily and stops once enough output exists, so a large response
+    is not serialized in full just to be truncated.
+    """
+    chunks = []
+    size = 0
+    for chunk in json.JSONEncoder(indent=2).iterencode(data):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            break
+    return ''.join(chunks)[:limit]
+
 
 class HealthDataExplorer:
     SCOPES = [
@@ -32,188 +63,289 @@ class HealthDataExplorer:
 
     def __init__(self):
         self.creds = None
-        self.token_file = 'token.pickle'
+        self.token_file = 'token.json'
+        self.legacy_token_file = 'token.pickle'
         self.credentials_file = 'credentials.json'
+        self.data_sources_cache_file = '.datasources_cache.json'
+        self.data_sources = None
+
+        # Every probe queries the same 7-day UTC window, ending when the run started
+        self.end_time = datetime.now(timezone.utc)
+        self.start_time = self.end_time - timedelta(days=7)
+
+        # Enough pooled connections for the probes that run concurrently
+        self.session = create_api_session(pool_maxsize=6)
+
+        # Transport for token refreshes, created on first refresh and reused after
+        self.auth_request = None
 
     def authenticate(self):
         """Authenticate with Google"""
-        if os.path.exists(self.token_file):
-            with open(self.token_file, 'rb') as token:
-                self.creds = pickle.load(token)
+        # Credentials already loaded in this process are reused until they expire
+        if self.creds and self.creds.valid:
+            return
+
+        # Load saved credentials if they exist
+        save_token = False
+        if self.creds is None:
+            if os.path.exists(self.token_file):
+                self.creds = Credentials.from_authorized_user_file(self.token_file)
+            elif os.path.exists(self.legacy_token_file):
+                # Older versions pickled the token; load it once and resave it as JSON
+                import pickle
+                with open(self.legacy_token_file, 'rb') as token:
+                    self.creds = pickle.load(token)
+                save_token = True
 
         if not self.creds or not self.creds.valid:
             if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
+                if self.auth_request is None:
+                    from google.auth.transport.requests import Request
+                    self.auth_request = Request()
+                self.creds.refresh(self.auth_request)
             else:
+                # Only needed for the interactive login, so import it here
+                from google_auth_oauthlib.flow import InstalledAppFlow
                 flow = InstalledAppFlow.from_client_secrets_file(
                     self.credentials_file, self.SCOPES)
                 self.creds = flow.run_local_server(port=0)
 
-            with open(self.token_file, 'wb') as token:
-                pickle.dump(self.creds, token)
+            save_token = True
+
+        if save_token:
+            with open(self.token_file, 'w', encoding='utf-8') as token:
+                token.write(self.creds.to_json())
+
+        self.session.headers['Authorization'] = f'Bearer {self.creds.token}'
 
         print("✓ Authenticated\n")
 
     def list_data_sources(self):
         """List all available data sources"""
+        # Sources are fetched once per run; later callers reuse the same list
+        if self.data_sources is not None:
+            return self.data_sources
+
         print("=" * 60)
         print("DISCOVERING DATA SOURCES")
         print("=" * 60)
 
-        url = "https://www.googleapis.com/fitness/v1/users/me/dataSources"
-        headers = {'Authorization': f'Bearer {self.creds.token}'}
+        url = f"{FITNESS_API_URL}/dataSources"
+
+        # The source list rarely changes, so revalidate the last response
+        # with its ETag instead of downloading it again
+        cache = self._load_data_sources_cache()
+        headers = {'If-None-Match': cache['etag']} if cache else {}
 
         try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            data = response.json()
+            response = self.session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+            if response.status_code == 304:
+                data = cache['body']
+            else:
+                response.raise_for_status()
+                data = response.json()
+                self._save_data_sources_cache(response.headers.get('ETag'), data)
 
             if 'dataSource' in data:
                 print(f"\nFound {len(data['dataSource'])} data sources:\n")
+
+                # Build the listing up front and write it in one go
+                entries = []
                 for idx, source in enumerate(data['dataSource'], 1):
-                    print(f"{idx}. {source.get('dataStreamId', 'Unknown')}")
-                    print(f"   Type: {source.get('dataType', {}).get('name', 'Unknown')}")
-                    print(f"   App: {source.get('application', {}).get('name', 'Unknown')}")
-                    print()
+                    data_type = source.get('dataType', {})
+                    application = source.get('application', {})
+                    entries.append(
+                        f"{idx}. {source.get('dataStreamId', 'Unknown')}\n"
+                        f"   Type: {data_type.get('name', 'Unknown')}\n"
+                        f"   App: {application.get('name', 'Unknown')}\n"
+                    )
+                print("\n".join(entries))
             else:
                 print("No data sources found!")
 
-            return data.get('dataSource', [])
+            self.data_sources = data.get('dataSource', [])
+            return self.data_sources
 
         except Exception as e:
             print(f"Error listing data sources: {e}")
             return []
 
-    def try_sleep_sessions(self):
-        """Try to get sleep sessions"""
-        print("\n" + "=" * 60)
-        print("METHOD 1: Sleep Sessions API")
-        print("=" * 60)
+    def _load_data_sources_cache(self):
+        """Load the cached data source response, if there is a usable one"""
+        try:
+            with open(self.data_sources_cache_file, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
 
-        end_time = datetime.now()
-        start_time = end_time - timedelta(days=7)
+        if not cache.get('etag') or 'body' not in cache:
+            return None
+        return cache
 
-        url = "https://www.googleapis.com/fitness/v1/users/me/sessions"
-        headers = {'Authorization': f'Bearer {self.creds.token}'}
-        params = {
-            'startTime': start_time.isoformat() + 'Z',
-            'endTime': end_time.isoformat() + 'Z',
-            'activityType': 72  # Sleep
-        }
+    def _save_data_sources_cache(self, etag, data):
+        """Cache a data source response together with its ETag"""
+        if not etag:
+            return
 
         try:
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status()
-            data = response.json()
+            with open(self.data_sources_cache_file, 'w', encoding='utf-8') as f:
+                json.dump({'etag': etag, 'body': data}, f)
+        except OSError as e:
+            print(f"Warning: Could not cache data sources: {e}")
 
-            print(f"\nResponse: {json.dumps(data, indent=2)[:500]}...")
+    def try_sleep_sessions(self):
+        """Try to get sleep sessions"""
+        with buffered_output() as out:
+            out("\n" + "=" * 60)
+            out("METHOD 1: Sleep Sessions API")
+            out("=" * 60)
+
+            start_time, end_time = self.start_time, self.end_time
+
+            url = f"{FITNESS_API_URL}/sessions"
+            params = {
+                'startTime': start_time.isoformat().replace('+00:00', 'Z'),
+                'endTime': end_time.isoformat().replace('+00:00', 'Z'),
+                'activityType': 72  # Sleep
+            }
 
-            if data.get('session'):
-                print(f"\n✓ Found {len(data['session'])} sleep sessions!")
-                return data['session']
-            else:
-                print("\n✗ No sleep sessions found")
-                return None
+            try:
+                response = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+                response.raise_for_status()
+                data = response.json()
 
-        except Exception as e:
-            print(f"\n✗ Error: {e}")
-            return None
+                out(f"\nResponse: {json_preview(data, 500)}...")
+
+                if data.get('session'):
+                    out(f"\n✓ Found {len(data['session'])} sleep sessions!")
+                    return data['session']
+                else:
+                    out("\n✗ No sleep sessions found")
+                    return None
+
+            except Exception as e:
+                out(f"\n✗ Error: {e}")
+                return None
 
     def try_aggregate_sleep_data(self):
         """Try aggregate endpoint for sleep"""
-        print("\n" + "=" * 60)
-        print("METHOD 2: Aggregate Sleep Data")
-        print("=" * 60)
+        with buffered_output() as out:
+            out("\n" + "=" * 60)
+            out("METHOD 2: Aggregate Sleep Data")
+            out("=" * 60)
 
-        end_time = datetime.now()
-        start_time = end_time - timedelta(days=7)
+            start_time, end_time = self.start_time, self.end_time
 
-        url = "https://www.googleapis.com/fitness/v1/users/me/dataset:aggregate"
-        headers = {'Authorization': f'Bearer {self.creds.token}'}
+            url = f"{FITNESS_API_URL}/dataset:aggregate"
 
-        # Try multiple data type names
-        sleep_data_types = [
-            "com.google.sleep.segment",
-            "com.google.activity.segment",
-            "com.google.sleep",
-        ]
+            # Try multiple data type names
+            sleep_data_types = [
+                "com.google.sleep.segment",
+                "com.google.activity.segment",
+                "com.google.sleep",
+            ]
 
-        for data_type in sleep_data_types:
-            print(f"\nTrying data type: {data_type}")
-
-            body = {
-                "aggregateBy": [{"dataTypeName": data_type}],
+            # Only the data type changes between attempts
+            window = {
                 "bucketByTime": {"durationMillis": 86400000},
                 "startTimeMillis": int(start_time.timestamp() * 1000),
                 "endTimeMillis": int(end_time.timestamp() * 1000)
             }
 
+            # Probe every data type at once, but take results in priority order so
+            # the highest-priority type with data wins regardless of response timing
+            executor = ThreadPoolExecutor(max_workers=len(sleep_data_types))
             try:
-                response = requests.post(url, headers=headers, json=body)
-                response.raise_for_status()
-                data = response.json()
-
-                if data.get('bucket'):
-                    has_data = any(
-                        bucket.get('dataset', [{}])[0].get('point')
-                        for bucket in data.get('bucket', [])
-                    )
-                    if has_data:
-                        print(f"✓ Found data!")
-                        print(json.dumps(data, indent=2)[:800])
+                futures = [
+                    executor.submit(self._probe_aggregate_data_type, url, data_type, window)
+                    for data_type in sleep_data_types
+                ]
+                for future in futures:
+                    lines, data = future.result()
+                    for line in lines:
+                        out(line)
+                    if data is not None:
                         return data
-                    else:
-                        print(f"✗ No data points")
-                else:
-                    print(f"✗ No buckets")
-
-            except Exception as e:
-                print(f"✗ Error: {e}")
+            finally:
+                # Don't wait for lower-priority probes once one has found data
+                executor.shutdown(wait=False, cancel_futures=True)
 
-        return None
+            return None
 
-    def try_dataset_read(self):
-        """Try direct dataset read"""
-        print("\n" + "=" * 60)
-        print("METHOD 3: Direct Dataset Read")
-        print("=" * 60)
+    def _probe_aggregate_data_type(self, url, data_type, window):
+        """Query the aggregate endpoint for one data type
 
-        end_time = datetime.now()
-        start_time = end_time - timedelta(days=7)
+        Returns the probe's output lines and the response if it contains data points.
+        """
+        lines = [f"\nTrying data type: {data_type}"]
+        body = {"aggregateBy": [{"dataTypeName": data_type}], **window}
 
-        start_ms = int(start_time.timestamp() * 1000000000)  # nanoseconds
-        end_ms = int(end_time.timestamp() * 1000000000)
+        try:
+            response = self.session.post(url, json=body, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            data = response.json()
 
-        data_types_to_try = [
-            "com.google.sleep.segment",
-            "com.google.heart_rate.bpm",
-            "com.google.step_count.delta",
-            "com.google.activity.segment",
-        ]
+            if data.get('bucket'):
+                has_data = any(
+                    bucket.get('dataset', [{}])[0].get('point')
+                    for bucket in data.get('bucket', [])
+                )
+                if has_data:
+                    lines.append(f"✓ Found data!")
+                    lines.append(json_preview(data, 800))
+                    return lines, data
+                else:
+                    lines.append(f"✗ No data points")
+            else:
+                lines.append(f"✗ No buckets")
 
-        for data_type in data_types_to_try:
-            print(f"\nTrying: {data_type}")
+        except Exception as e:
+            lines.append(f"✗ Error: {e}")
 
-            url = f"https://www.googleapis.com/fitness/v1/users/me/dataSources/derived:{data_type}:com.google.android.gms:merge_sleep_segments/datasets/{start_ms}-{end_ms}"
-            headers = {'Authorization': f'Bearer {self.creds.token}'}
+        return lines, None
 
-            try:
-                response = requests.get(url, headers=headers)
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get('point'):
-                        print(f"✓ Found {len(data['point'])} data points!")
-                        print(json.dumps(data, indent=2)[:800])
-                        return data
+    def try_dataset_read(self):
+        """Try direct dataset read"""
+        with buffered_output() as out:
+            out("\n" + "=" * 60)
+            out("METHOD 3: Direct Dataset Read")
+            out("=" * 60)
+
+            start_time, end_time = self.start_time, self.end_time
+
+            start_ns = int(start_time.timestamp() * 1000000000)
+            end_ns = int(end_time.timestamp() * 1000000000)
+            dataset_id = f"{start_ns}-{end_ns}"
+
+            data_types_to_try = [
+                "com.google.sleep.segment",
+                "com.google.heart_rate.bpm",
+                "com.google.step_count.delta",
+                "com.google.activity.segment",
+            ]
+
+            for data_type in data_types_to_try:
+                out(f"\nTrying: {data_type}")
+
+                url = f"{FITNESS_API_URL}/dataSources/derived:{data_type}:com.google.android.gms:merge_sleep_segments/datasets/{dataset_id}"
+
+                try:
+                    response = self.session.get(url, timeout=REQUEST_TIMEOUT)
+                    if response.status_code == 200:
+                        data = response.json()
+                        if data.get('point'):
+                            out(f"✓ Found {len(data['point'])} data points!")
+                            out(json_preview(data, 800))
+                            return data
+                        else:
+                            out(f"✗ No points")
                     else:
-                        print(f"✗ No points")
-                else:
-                    print(f"✗ Status {response.status_code}")
+                        out(f"✗ Status {response.status_code}")
 
-            except Exception as e:
-                print(f"✗ Error: {e}")
+                except Exception as e:
+                    out(f"✗ Error: {e}")
 
-        return None
+            return None
 
     def check_health_connect_sync(self):
         """Check if Health Connect is syncing to Google Fit"""
@@ -224,8 +356,15 @@ class HealthDataExplorer:
         # Look for Samsung Health data source
         sources = self.list_data_sources()
 
-        samsung_sources = [s for s in sources if 'samsung' in str(s).lower()]
-        health_connect_sources = [s for s in sources if 'health' in str(s).lower()]
+        # One pass, lowercasing each source's text once for both checks
+        samsung_sources = []
+        health_connect_sources = []
+        for source in sources:
+            text = str(source).lower()
+            if 'samsung' in text:
+                samsung_sources.append(source)
+            if 'health' in text:
+                health_connect_sources.append(source)
 
         if samsung_sources:
             print("\n✓ Found Samsung Health data sources:")
@@ -257,9 +396,10 @@ class HealthDataExplorer:
         self.check_health_connect_sync()
 
         # 3. Try getting sleep data different ways
-        self.try_sleep_sessions()
-        self.try_aggregate_sleep_data()
-        self.try_dataset_read()
+        # The probes are independent, so run them concurrently
+        probes = [self.try_sleep_sessions, self.try_aggregate_sleep_data, self.try_dataset_read]
+        with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+            list(executor.map(lambda probe: probe(), probes))
 
         print("\n" + "=" * 60)
         print("DISCOVERY COMPLETE")
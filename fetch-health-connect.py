@@ -18,22 +18,23 @@ Usage:
 
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Any, List
-import statistics
+from typing import Dict, Any, List, Tuple
 
 # Check for required dependencies
 try:
     import requests
     from google.oauth2.credentials import Credentials
-    from google_auth_oauthlib.flow import InstalledAppFlow
-    from google.auth.transport.requests import Request
-    import pickle
 except ImportError:
     print("Missing required dependencies. Install with:")
     print("pip install google-auth google-auth-oauthlib google-auth-httplib2 requests")
     exit(1)
 
+from health_common import (
+    FITNESS_API_URL, REQUEST_TIMEOUT, create_api_session, energy_level, write_json_atomic
+)
+
 
 class HealthConnectClient:
     """Client for fetching data from Health Connect API"""
@@ -44,22 +45,71 @@ class HealthConnectClient:
         'https://www.googleapis.com/auth/fitness.activity.read',
     ]
 
+    # Static part of the aggregate request; the data types and window are merged in per call
+    AGGREGATE_QUERY = {
+        "bucketByTime": {"durationMillis": 86400000},  # 1 day
+    }
+
+    # Data types for the aggregate endpoint. It accepts several per request,
+    # so heart rate and activity normally share a single round trip
+    HEART_RATE_TYPES = (
+        {"dataTypeName": "com.google.heart_rate.bpm"},
+    )
+    ACTIVITY_TYPES = (
+        {"dataTypeName": "com.google.step_count.delta"},
+        {"dataTypeName": "com.google.calories.expended"},
+        {"dataTypeName": "com.google.active_minutes"},
+    )
+    AGGREGATE_TYPES = HEART_RATE_TYPES + ACTIVITY_TYPES
+
+    # Statuses Fit returns when one of the requested data types has no data
+    # source. Auth (401) and throttling (429) errors affect every type alike.
+    MISSING_SOURCE_STATUSES = (400, 403, 404)
+
+    # dataSourceId fragment -> (daily activity total, value field)
+    ACTIVITY_FIELDS = (
+        ('step_count', 'steps', 'intVal'),
+        ('calories', 'calories', 'fpVal'),
+        ('active_minutes', 'activeMinutes', 'intVal'),
+    )
+
     def __init__(self):
         self.creds = None
-        self.token_file = 'token.pickle'
+        self.token_file = 'token.json'
+        self.legacy_token_file = 'token.pickle'
         self.credentials_file = 'credentials.json'
 
+        # Sleep and the aggregate query are fetched concurrently
+        self.session = create_api_session(pool_maxsize=2)
+
+        # Transport for token refreshes, created on first refresh and reused after
+        self.auth_request = None
+
     def authenticate(self):
         """Authenticate with Google Health Connect API"""
+        # Credentials already loaded in this process are reused until they expire
+        if self.creds and self.creds.valid:
+            return
+
         # Load saved credentials if they exist
-        if os.path.exists(self.token_file):
-            with open(self.token_file, 'rb') as token:
-                self.creds = pickle.load(token)
+        save_token = False
+        if self.creds is None:
+            if os.path.exists(self.token_file):
+                self.creds = Credentials.from_authorized_user_file(self.token_file)
+            elif os.path.exists(self.legacy_token_file):
+                # Older versions pickled the token; load it once and resave it as JSON
+                import pickle
+                with open(self.legacy_token_file, 'rb') as token:
+                    self.creds = pickle.load(token)
+                save_token = True
 
         # If credentials are invalid or don't exist, get new ones
         if not self.creds or not self.creds.valid:
             if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
+                if self.auth_request is None:
+                    from google.auth.transport.requests import Request
+                    self.auth_request = Request()
+                self.creds.refresh(self.auth_request)
             else:
                 if not os.path.exists(self.credentials_file):
                     print(f"Error: {self.credentials_file} not found!")
@@ -67,37 +117,36 @@ class HealthConnectClient:
                     print("See HEALTH_CONNECT_SETUP.md for instructions")
                     exit(1)
 
+                # Only needed for the interactive login, so import it here
+                from google_auth_oauthlib.flow import InstalledAppFlow
                 flow = InstalledAppFlow.from_client_secrets_file(
                     self.credentials_file, self.SCOPES)
                 self.creds = flow.run_local_server(port=0)
 
-            # Save credentials for next time
-            with open(self.token_file, 'wb') as token:
-                pickle.dump(self.creds, token)
+            save_token = True
 
-        print("✓ Authenticated successfully")
+        # Save credentials for next time
+        if save_token:
+            with open(self.token_file, 'w', encoding='utf-8') as token:
+                token.write(self.creds.to_json())
 
-    def get_sleep_data(self, days: int = 7) -> Dict[str, Any]:
-        """Fetch sleep data from Health Connect"""
-        end_time = datetime.now()
-        start_time = end_time - timedelta(days=days)
+        self.session.headers['Authorization'] = f'Bearer {self.creds.token}'
 
-        # Health Connect REST API endpoint
-        url = "https://www.googleapis.com/fitness/v1/users/me/sessions"
+        print("✓ Authenticated successfully")
 
-        headers = {
-            'Authorization': f'Bearer {self.creds.token}',
-            'Content-Type': 'application/json'
-        }
+    def get_sleep_data(self, start_time: datetime, end_time: datetime) -> Dict[str, Any]:
+        """Fetch sleep data from Health Connect for a UTC time window"""
+        # Health Connect REST API endpoint
+        url = f"{FITNESS_API_URL}/sessions"
 
         params = {
-            'startTime': start_time.isoformat() + 'Z',
-            'endTime': end_time.isoformat() + 'Z',
+            'startTime': start_time.isoformat().replace('+00:00', 'Z'),
+            'endTime': end_time.isoformat().replace('+00:00', 'Z'),
             'activityType': 72  # Sleep activity type
         }
 
         try:
-            response = requests.get(url, headers=headers, params=params)
+            response = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
             response.raise_for_status()
             data = response.json()
 
@@ -111,71 +160,83 @@ class HealthConnectClient:
             print(f"Error fetching sleep data: {e}")
             return None
 
-    def get_heart_rate_data(self, days: int = 1) -> Dict[str, Any]:
-        """Fetch heart rate data from Health Connect"""
-        end_time = datetime.now()
-        start_time = end_time - timedelta(days=days)
+    def get_aggregated_data(self, start_time: datetime,
+                            end_time: datetime) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Fetch heart rate and activity data from Health Connect in one request
 
-        url = "https://www.googleapis.com/fitness/v1/users/me/dataset:aggregate"
+        Returns a (heart_rate, activity) tuple; either entry is None if unavailable.
+        """
+        try:
+            data = self._post_aggregate(self.AGGREGATE_TYPES, start_time, end_time)
+
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status not in self.MISSING_SOURCE_STATUSES:
+                print(f"Error fetching heart rate and activity data: {e}")
+                return None, None
+
+            # A missing source for one data type (e.g. no heart rate stream on the
+            # account) rejects the whole request, so fetch each separately to keep the other
+            print(f"Combined heart rate and activity request failed ({status}), "
+                  f"fetching them separately")
+            return (self._fetch_aggregate("heart rate", self.HEART_RATE_TYPES,
+                                          self._process_heart_rate_data, start_time, end_time),
+                    self._fetch_aggregate("activity", self.ACTIVITY_TYPES,
+                                          self._process_activity_data, start_time, end_time))
 
-        headers = {
-            'Authorization': f'Bearer {self.creds.token}',
-            'Content-Type': 'application/json'
-        }
+        except requests.exceptions.RequestException as e:
+            print(f"Error fetching heart rate and activity data: {e}")
+            return None, None
 
-        body = {
-            "aggregateBy": [{
-                "dataTypeName": "com.google.heart_rate.bpm"
-            }],
-            "bucketByTime": {"durationMillis": 86400000},  # 1 day
-            "startTimeMillis": int(start_time.timestamp() * 1000),
-            "endTimeMillis": int(end_time.timestamp() * 1000)
-        }
+        hr_data, activity_data = self._split_aggregate_response(data)
+        return (self._process_heart_rate_data(hr_data),
+                self._process_activity_data(activity_data))
 
+    def _fetch_aggregate(self, label: str, data_types: Tuple[Dict[str, str], ...], process,
+                         start_time: datetime, end_time: datetime) -> Dict[str, Any]:
+        """Fetch and process one group of data types, or return None if the request fails"""
         try:
-            response = requests.post(url, headers=headers, json=body)
-            response.raise_for_status()
-            data = response.json()
-
-            return self._process_heart_rate_data(data)
-
+            data = self._post_aggregate(data_types, start_time, end_time)
         except requests.exceptions.RequestException as e:
-            print(f"Error fetching heart rate data: {e}")
+            print(f"Error fetching {label} data: {e}")
             return None
 
-    def get_activity_data(self, days: int = 1) -> Dict[str, Any]:
-        """Fetch activity/steps data from Health Connect"""
-        end_time = datetime.now()
-        start_time = end_time - timedelta(days=days)
-
-        url = "https://www.googleapis.com/fitness/v1/users/me/dataset:aggregate"
+        return process(data)
 
-        headers = {
-            'Authorization': f'Bearer {self.creds.token}',
-            'Content-Type': 'application/json'
-        }
+    def _post_aggregate(self, data_types: Tuple[Dict[str, str], ...],
+                        start_time: datetime, end_time: datetime) -> Dict:
+        """POST a daily-bucketed aggregate query and return the raw response"""
+        url = f"{FITNESS_API_URL}/dataset:aggregate"
 
         body = {
-            "aggregateBy": [
-                {"dataTypeName": "com.google.step_count.delta"},
-                {"dataTypeName": "com.google.calories.expended"},
-                {"dataTypeName": "com.google.active_minutes"}
-            ],
-            "bucketByTime": {"durationMillis": 86400000},
+            **self.AGGREGATE_QUERY,
+            "aggregateBy": data_types,
             "startTimeMillis": int(start_time.timestamp() * 1000),
             "endTimeMillis": int(end_time.timestamp() * 1000)
         }
 
-        try:
-            response = requests.post(url, headers=headers, json=body)
-            response.raise_for_status()
-            data = response.json()
+        response = self.session.post(url, json=body, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
 
-            return self._process_activity_data(data)
+    def _split_aggregate_response(self, data: Dict) -> Tuple[Dict, Dict]:
+        """Split a combined aggregate response into heart rate and activity responses"""
+        hr_buckets = []
+        activity_buckets = []
 
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching activity data: {e}")
-            return None
+        for bucket in data.get('bucket', []):
+            hr_datasets = []
+            activity_datasets = []
+            for dataset in bucket.get('dataset', []):
+                if 'heart_rate' in dataset.get('dataSourceId', ''):
+                    hr_datasets.append(dataset)
+                else:
+                    activity_datasets.append(dataset)
+
+            hr_buckets.append({'dataset': hr_datasets})
+            activity_buckets.append({'dataset': activity_datasets})
+
+        return {'bucket': hr_buckets}, {'bucket': activity_buckets}
 
     def _calculate_sleep_metrics(self, session: Dict) -> Dict[str, Any]:
         """Calculate sleep metrics for a single session"""
@@ -194,8 +255,9 @@ class HealthConnectClient:
         # Calculate sleep score (simplified algorithm)
         # Duration: 8 hours = 40 points, Deep sleep quality: up to 30 points, REM: up to 30 points
         duration_score = min(40, (duration_hours / 8) * 40)
-        deep_score = (deep_sleep / duration_hours) * 30 if duration_hours > 0 else 0
-        rem_score = (rem_sleep / duration_hours) * 30 if duration_hours > 0 else 0
+        # duration_hours is known to be positive here, so the ratios need no guard
+        deep_score = (deep_sleep / duration_hours) * 30
+        rem_score = (rem_sleep / duration_hours) * 30
         sleep_score = min(100, int(duration_score + deep_score + rem_score))
 
         # Calculate energy score based on sleep quality and duration
@@ -235,19 +297,15 @@ class HealthConnectClient:
         start_time = datetime.fromtimestamp(latest['startMs'] / 1000)
         end_time = datetime.fromtimestamp(latest['endMs'] / 1000)
 
-        energy_level = (
-            "High Energy" if latest['energyScore'] >= 80 else
-            "Good" if latest['energyScore'] >= 70 else
-            "Moderate" if latest['energyScore'] >= 60 else
-            "Low"
-        )
-
         # Calculate weekly averages from ALL sessions (up to 7 days)
-        sleep_scores = [m['score'] for m in all_metrics]
-        energy_scores = [m['energyScore'] for m in all_metrics]
-        durations = [m['duration'] for m in all_metrics]
+        total_score = total_energy = total_duration = 0
+        for m in all_metrics:
+            total_score += m['score']
+            total_energy += m['energyScore']
+            total_duration += m['duration']
+        sessions_analyzed = len(all_metrics)
 
-        print(f"    Processing {len(all_metrics)} sleep sessions for weekly averages")
+        print(f"    Processing {sessions_analyzed} sleep sessions for weekly averages")
 
         return {
             'daily': {
@@ -261,13 +319,13 @@ class HealthConnectClient:
             },
             'energy': {
                 'score': latest['energyScore'],
-                'level': energy_level
+                'level': energy_level(latest['energyScore'])
             },
             'weekly': {
-                'averageSleepScore': round(statistics.mean(sleep_scores)),
-                'averageEnergyScore': round(statistics.mean(energy_scores)),
-                'averageSleepDuration': round(statistics.mean(durations), 1),
-                'sessionsAnalyzed': len(all_metrics)
+                'averageSleepScore': round(total_score / sessions_analyzed),
+                'averageEnergyScore': round(total_energy / sessions_analyzed),
+                'averageSleepDuration': round(total_duration / sessions_analyzed, 1),
+                'sessionsAnalyzed': sessions_analyzed
             }
         }
 
@@ -276,20 +334,28 @@ class HealthConnectClient:
         daily_hr_data = []
 
         for bucket in data.get('bucket', []):
-            bucket_values = []
+            # Running stats for the day, updated in a single pass over the samples
+            count = total = 0
+            lowest = highest = None
             for dataset in bucket.get('dataset', []):
                 for point in dataset.get('point', []):
                     for value in point.get('value', []):
                         hr = value.get('fpVal')
                         if hr and hr > 30 and hr < 220:  # Validate reasonable HR range
-                            bucket_values.append(int(hr))
-
-            if bucket_values:
+                            hr = int(hr)
+                            count += 1
+                            total += hr
+                            if lowest is None or hr < lowest:
+                                lowest = hr
+                            if highest is None or hr > highest:
+                                highest = hr
+
+            if count:
                 daily_hr_data.append({
-                    'resting': min(bucket_values),
-                    'average': round(statistics.mean(bucket_values)),
-                    'max': max(bucket_values),
-                    'min': min(bucket_values)
+                    'resting': lowest,
+                    'average': round(total / count),
+                    'max': highest,
+                    'min': lowest
                 })
 
         if not daily_hr_data:
@@ -300,7 +366,7 @@ class HealthConnectClient:
         latest = daily_hr_data[-1]
 
         # Calculate weekly average resting HR
-        weekly_resting = round(statistics.mean([d['resting'] for d in daily_hr_data]))
+        weekly_resting = round(sum(d['resting'] for d in daily_hr_data) / len(daily_hr_data))
 
         print(f"    Processing {len(daily_hr_data)} days of heart rate data")
 
@@ -318,29 +384,25 @@ class HealthConnectClient:
         daily_activity = []
 
         for bucket in data.get('bucket', []):
-            day_steps = 0
-            day_calories = 0
-            day_active_mins = 0
+            day_totals = {'steps': 0, 'calories': 0, 'activeMinutes': 0}
 
             for dataset in bucket.get('dataset', []):
                 data_type = dataset.get('dataSourceId', '')
 
+                # Resolve which total this dataset feeds once, not per value
+                for fragment, field, value_key in self.ACTIVITY_FIELDS:
+                    if fragment in data_type:
+                        break
+                else:
+                    continue
+
                 for point in dataset.get('point', []):
                     for value in point.get('value', []):
-                        if 'step_count' in data_type:
-                            day_steps += int(value.get('intVal', 0))
-                        elif 'calories' in data_type:
-                            day_calories += int(value.get('fpVal', 0))
-                        elif 'active_minutes' in data_type:
-                            day_active_mins += int(value.get('intVal', 0))
+                        day_totals[field] += int(value.get(value_key, 0))
 
             # Only add days with actual data
-            if day_steps > 0 or day_calories > 0:
-                daily_activity.append({
-                    'steps': day_steps,
-                    'calories': day_calories,
-                    'activeMinutes': day_active_mins
-                })
+            if day_totals['steps'] > 0 or day_totals['calories'] > 0:
+                daily_activity.append(day_totals)
 
         if not daily_activity:
             print("Warning: No activity data found in API response")
@@ -351,7 +413,7 @@ class HealthConnectClient:
 
         # Calculate weekly average steps
         all_steps = [d['steps'] for d in daily_activity if d['steps'] > 0]
-        weekly_steps = round(statistics.mean(all_steps)) if all_steps else 0
+        weekly_steps = round(sum(all_steps) / len(all_steps)) if all_steps else 0
 
         print(f"    Processing {len(daily_activity)} days of activity data")
 
@@ -369,9 +431,13 @@ def main():
     print("Health Connect Data Fetcher")
     print("=" * 50)
 
+    # One timestamp for the whole run: the fetch window, fetchTime and lastUpdated
+    now = datetime.now(timezone.utc)
+    timestamp = now.isoformat().replace('+00:00', 'Z')
+
     # Diagnostic tracking
     diagnostics = {
-        'fetchTime': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'),
+        'fetchTime': timestamp,
         'dataFetched': {},
         'errors': []
     }
@@ -390,10 +456,17 @@ def main():
     print("\nFetching health data from API...")
 
     # Fetch all data (returns None if fails)
-    # Note: We fetch 7 days for weekly averages
-    sleep_data = client.get_sleep_data(days=7)
-    hr_data = client.get_heart_rate_data(days=7)
-    activity_data = client.get_activity_data(days=7)
+    # Note: We fetch 7 days for weekly averages, using the same window for every request
+    end_time = now
+    start_time = end_time - timedelta(days=7)
+
+    # The requests are independent, so issue them concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sleep_future = executor.submit(client.get_sleep_data, start_time, end_time)
+        aggregate_future = executor.submit(client.get_aggregated_data, start_time, end_time)
+
+    sleep_data = sleep_future.result()
+    hr_data, activity_data = aggregate_future.result()
 
     # Track what was successfully fetched
     diagnostics['dataFetched']['sleep'] = sleep_data is not None
@@ -414,12 +487,11 @@ def main():
         exit(1)
 
     # Build health data structure - only include data that was successfully fetched
-    now = datetime.now(timezone.utc)
     health_data = {
-        'lastUpdated': now.isoformat().replace('+00:00', 'Z'),
+        'lastUpdated': timestamp,
         'dataSource': 'Health Connect API',
         'dailyStats': {
-            'date': datetime.now().strftime('%Y-%m-%d'),
+            'date': now.astimezone().strftime('%Y-%m-%d'),
         },
         'weeklyTrends': {}
     }
@@ -464,8 +536,7 @@ def main():
     # Save to JSON file
     output_file = 'health-data.json'
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(health_data, f, indent=2)
+        write_json_atomic(output_file, health_data)
         print(f"\n✓ Health data saved to {output_file}")
     except Exception as e:
         error_msg = f"Failed to save health data: {e}"
@@ -495,8 +566,7 @@ def save_diagnostics(diagnostics: Dict[str, Any], success: bool):
     diagnostics['success'] = success
 
     try:
-        with open('health-data-diagnostics.json', 'w', encoding='utf-8') as f:
-            json.dump(diagnostics, f, indent=2)
+        write_json_atomic('health-data-diagnostics.json', diagnostics)
         print(f"\n📊 Diagnostics saved to health-data-diagnostics.json")
     except Exception as e:
         print(f"Warning: Could not save diagnostics: {e}")
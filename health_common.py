@@ -0,0 +1,73 @@
+"""
+Shared helpers for the health data scripts
+
+Imported by fetch-health-connect.py, discover-health-data.py and
+update-health-data.py so the API settings, energy bands and JSON writer are
+defined once. Only the standard library is imported at module level, which
+keeps the CSV updater usable without the Google API dependencies.
+"""
+
+import json
+import os
+from bisect import bisect_right
+from typing import Dict, Any
+
+FITNESS_API_URL = "https://www.googleapis.com/fitness/v1/users/me"
+
+# Fail fast on a stuck connection instead of hanging the run
+REQUEST_TIMEOUT = (5, 20)  # (connect, read) seconds
+
+# Energy score bands: below 60 is Low, 60-69 Moderate, 70-79 Good, 80+ High Energy
+ENERGY_THRESHOLDS = (60, 70, 80)
+ENERGY_LEVELS = ("Low", "Moderate", "Good", "High Energy")
+
+
+def energy_level(score: int) -> str:
+    """Return the label of the energy band a score falls in"""
+    return ENERGY_LEVELS[bisect_right(ENERGY_THRESHOLDS, score)]
+
+
+def create_api_session(pool_maxsize: int):
+    """Create a requests session for the Fitness API
+
+    All calls share one connection pool, so they reuse the same TLS connection.
+    Rate limiting and transient server errors are retried with exponential
+    backoff; the final response is handed back for raise_for_status().
+    """
+    # Imported here so scripts that never call the API don't need requests
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry_policy = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'POST']),
+        raise_on_status=False,
+    )
+
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry_policy))
+    return session
+
+
+def write_json_atomic(path: str, data: Dict[str, Any]):
+    """Write data as indented JSON, replacing path only once the write succeeds
+
+    A failed or interrupted write leaves the previous file in place rather
+    than a truncated one.
+    """
+    # Serialize up front so the file is written with a single buffered write
+    payload = json.dumps(data, indent=2).encode('utf-8')
+
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
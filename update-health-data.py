@@ -19,24 +19,69 @@ To export data from Samsung Health:
 import json
 import csv
 import argparse
-from datetime import datetime, timedelta
+import heapq
+import re
+from bisect import bisect_right
+from collections import deque
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import Dict, List, Any
-import statistics
+
+from health_common import energy_level, write_json_atomic
+
+
+# Times accepted by _parse_time, with the same field ranges as strptime's
+# '%H:%M[:%S]' (24-hour) and '%I:%M[:%S] %p' (12-hour) formats
+TIME_PATTERN = re.compile(
+    r"(2[0-3]|[01]\d|\d):([0-5]\d|\d)(?::(?:[0-5]\d|\d))?"
+    r"|(1[0-2]|0[1-9]|[1-9]):([0-5]\d|\d)(?::(?:[0-5]\d|\d))?\s+([AP]M)",
+    re.IGNORECASE
+)
+
+
+def read_csv_window(filepath: str, maxlen: int, date: str = None):
+    """Stream a CSV export, keeping only the last `maxlen` rows and the rows for `date`
+
+    Returns (record_count, recent_rows, date_rows) so large exports never sit in memory whole.
+    """
+    record_count = 0
+    recent_rows = deque(maxlen=maxlen)
+    date_rows = []
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            record_count += 1
+            recent_rows.append(row)
+            if date is not None and date in row.get("Date", ""):
+                date_rows.append(row)
+    return record_count, recent_rows, date_rows
 
 
 class HealthDataProcessor:
+    # Headers the energy score has appeared under, in order of preference
+    ENERGY_KEYS = ("Energy score", "Energy", "energy_score")
+
+    # Stress bands: below 40 is Low, 40-69 Medium, 70+ High
+    STRESS_THRESHOLDS = (40, 70)
+    STRESS_LEVELS = ("Low", "Medium", "High")
+
     def __init__(self):
+        # One timestamp for the whole run: lastUpdated, fetchTime and today's date
+        now = datetime.now(timezone.utc)
+        timestamp = now.isoformat().replace('+00:00', 'Z')
+
+        # Local date the daily stats describe, also used to pick today's CSV rows
+        self.today = now.astimezone().strftime("%Y-%m-%d")
+
         self.data = {
-            "lastUpdated": datetime.utcnow().isoformat() + "Z",
+            "lastUpdated": timestamp,
             "dataSource": "Samsung Health CSV",
             "dailyStats": {
-                "date": datetime.now().strftime("%Y-%m-%d"),
+                "date": self.today,
             },
             "weeklyTrends": {}
         }
         self.diagnostics = {
-            'fetchTime': datetime.utcnow().isoformat() + "Z",
+            'fetchTime': timestamp,
             'dataProcessed': {},
             'errors': []
         }
@@ -51,11 +96,10 @@ class HealthDataProcessor:
             return
 
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                sleep_records = list(reader)
+            # Only the last week of nights is needed
+            record_count, recent_records, _ = read_csv_window(filepath, 7)
 
-            if not sleep_records:
+            if not record_count:
                 error_msg = "No sleep data found in CSV file"
                 print(f"Warning: {error_msg}")
                 self.diagnostics['errors'].append(error_msg)
@@ -63,7 +107,7 @@ class HealthDataProcessor:
                 return
 
             # Get most recent sleep record
-            latest = sleep_records[-1]
+            latest = recent_records[-1]
 
             # Parse sleep data (adjust field names based on actual Samsung Health CSV)
             # These are common field names - you may need to adjust based on your export
@@ -77,12 +121,14 @@ class HealthDataProcessor:
                 "wakeTime": self._parse_time(latest.get("Wake time", "07:00"))
             }
 
-            # Extract energy score if available (may be in same CSV or separate)
-            energy_score = latest.get("Energy score") or latest.get("Energy") or latest.get("energy_score")
+            # Extract energy score if available (may be in same CSV or separate).
+            # Every row shares the CSV header, so find the energy columns once.
+            energy_keys = [k for k in self.ENERGY_KEYS if k in latest]
+            energy_score = next((latest[k] for k in energy_keys if latest[k]), None)
             if energy_score:
                 try:
                     score = int(energy_score)
-                    level = "High Energy" if score >= 80 else "Good" if score >= 70 else "Moderate" if score >= 60 else "Low"
+                    level = energy_level(score)
                     self.data["dailyStats"]["energy"] = {
                         "score": score,
                         "level": level
@@ -91,11 +137,10 @@ class HealthDataProcessor:
                     pass
 
             # Calculate weekly average
-            recent_records = sleep_records[-7:] if len(sleep_records) >= 7 else sleep_records
             sleep_scores = [int(r.get("Sleep score", 87)) for r in recent_records if r.get("Sleep score")]
             energy_scores = []
             for r in recent_records:
-                e_score = r.get("Energy score") or r.get("Energy") or r.get("energy_score")
+                e_score = next((r[k] for k in energy_keys if r[k]), None)
                 if e_score:
                     try:
                         energy_scores.append(int(e_score))
@@ -104,14 +149,14 @@ class HealthDataProcessor:
             durations = [self._parse_duration(r.get("Sleep time", "0")) for r in recent_records]
 
             if sleep_scores:
-                self.data["weeklyTrends"]["averageSleepScore"] = round(statistics.mean(sleep_scores))
+                self.data["weeklyTrends"]["averageSleepScore"] = round(sum(sleep_scores) / len(sleep_scores))
             if energy_scores:
-                self.data["weeklyTrends"]["averageEnergyScore"] = round(statistics.mean(energy_scores))
+                self.data["weeklyTrends"]["averageEnergyScore"] = round(sum(energy_scores) / len(energy_scores))
             if durations:
-                self.data["weeklyTrends"]["averageSleepDuration"] = round(statistics.mean(durations), 1)
+                self.data["weeklyTrends"]["averageSleepDuration"] = round(sum(durations) / len(durations), 1)
 
             self.diagnostics['dataProcessed']['sleep'] = True
-            print(f"✓ Processed sleep data: {len(sleep_records)} records")
+            print(f"✓ Processed sleep data: {record_count} records")
 
         except Exception as e:
             error_msg = f"Error processing sleep data: {e}"
@@ -129,43 +174,41 @@ class HealthDataProcessor:
             return
 
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                hr_records = list(reader)
+            # Keep the last 100 readings for the weekly trend plus today's readings
+            record_count, recent_records, today_records = read_csv_window(filepath, 100, self.today)
 
-            if not hr_records:
+            if not record_count:
                 error_msg = "No heart rate data found in CSV file"
                 print(f"Warning: {error_msg}")
                 self.diagnostics['errors'].append(error_msg)
                 self.diagnostics['dataProcessed']['heartRate'] = False
                 return
 
-            # Get today's records
-            today = datetime.now().strftime("%Y-%m-%d")
-            today_records = [r for r in hr_records if today in r.get("Date", "")]
-
             if today_records:
                 hr_values = [int(r.get("Heart rate", 70)) for r in today_records if r.get("Heart rate")]
 
                 if hr_values:
+                    # Today's lowest reading doubles as the resting estimate
+                    lowest = min(hr_values)
                     self.data["dailyStats"]["heartRate"] = {
-                        "resting": min(hr_values),
-                        "average": round(statistics.mean(hr_values)),
+                        "resting": lowest,
+                        "average": round(sum(hr_values) / len(hr_values)),
                         "max": max(hr_values),
-                        "min": min(hr_values)
+                        "min": lowest
                     }
 
                     # Weekly resting HR average
-                    recent_records = hr_records[-100:] if len(hr_records) >= 100 else hr_records
                     recent_hr = [int(r.get("Heart rate", 70)) for r in recent_records if r.get("Heart rate")]
                     if recent_hr:
-                        # Approximate resting HR as lowest 10th percentile
-                        sorted_hr = sorted(recent_hr)
-                        resting_hrs = sorted_hr[:len(sorted_hr)//10] if len(sorted_hr) > 10 else sorted_hr
-                        self.data["weeklyTrends"]["averageRestingHR"] = round(statistics.mean(resting_hrs))
+                        # Approximate resting HR as lowest 10th percentile (selected without a full sort)
+                        if len(recent_hr) > 10:
+                            resting_hrs = heapq.nsmallest(len(recent_hr) // 10, recent_hr)
+                        else:
+                            resting_hrs = recent_hr
+                        self.data["weeklyTrends"]["averageRestingHR"] = round(sum(resting_hrs) / len(resting_hrs))
 
             self.diagnostics['dataProcessed']['heartRate'] = True
-            print(f"✓ Processed heart rate data: {len(hr_records)} records")
+            print(f"✓ Processed heart rate data: {record_count} records")
 
         except Exception as e:
             error_msg = f"Error processing heart rate data: {e}"
@@ -183,18 +226,16 @@ class HealthDataProcessor:
             return
 
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                activity_records = list(reader)
+            record_count, recent_records, _ = read_csv_window(filepath, 7)
 
-            if not activity_records:
+            if not record_count:
                 error_msg = "No activity data found in CSV file"
                 print(f"Warning: {error_msg}")
                 self.diagnostics['errors'].append(error_msg)
                 self.diagnostics['dataProcessed']['activity'] = False
                 return
 
-            latest = activity_records[-1]
+            latest = recent_records[-1]
 
             self.data["dailyStats"]["activity"] = {
                 "steps": int(latest.get("Step count", 8000)),
@@ -203,13 +244,12 @@ class HealthDataProcessor:
             }
 
             # Weekly average steps
-            recent_records = activity_records[-7:] if len(activity_records) >= 7 else activity_records
             steps = [int(r.get("Step count", 0)) for r in recent_records if r.get("Step count")]
             if steps:
-                self.data["weeklyTrends"]["averageSteps"] = round(statistics.mean(steps))
+                self.data["weeklyTrends"]["averageSteps"] = round(sum(steps) / len(steps))
 
             self.diagnostics['dataProcessed']['activity'] = True
-            print(f"✓ Processed activity data: {len(activity_records)} records")
+            print(f"✓ Processed activity data: {record_count} records")
 
         except Exception as e:
             error_msg = f"Error processing activity data: {e}"
@@ -227,25 +267,21 @@ class HealthDataProcessor:
             return
 
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                stress_records = list(reader)
+            # Only today's readings are used, so no tail window is kept
+            record_count, _, today_records = read_csv_window(filepath, 0, self.today)
 
-            if not stress_records:
+            if not record_count:
                 error_msg = "No stress data found in CSV file"
                 print(f"Warning: {error_msg}")
                 self.diagnostics['errors'].append(error_msg)
                 self.diagnostics['dataProcessed']['stress'] = False
                 return
 
-            today = datetime.now().strftime("%Y-%m-%d")
-            today_records = [r for r in stress_records if today in r.get("Date", "")]
-
             if today_records:
                 stress_values = [int(r.get("Stress", 35)) for r in today_records if r.get("Stress")]
                 if stress_values:
-                    avg_stress = round(statistics.mean(stress_values))
-                    level = "Low" if avg_stress < 40 else "Medium" if avg_stress < 70 else "High"
+                    avg_stress = round(sum(stress_values) / len(stress_values))
+                    level = self.STRESS_LEVELS[bisect_right(self.STRESS_THRESHOLDS, avg_stress)]
 
                     self.data["dailyStats"]["stress"] = {
                         "average": avg_stress,
@@ -253,7 +289,7 @@ class HealthDataProcessor:
                     }
 
             self.diagnostics['dataProcessed']['stress'] = True
-            print(f"✓ Processed stress data: {len(stress_records)} records")
+            print(f"✓ Processed stress data: {record_count} records")
 
         except Exception as e:
             error_msg = f"Error processing stress data: {e}"
@@ -268,15 +304,15 @@ class HealthDataProcessor:
             minutes = 0
 
             if 'h' in duration_str:
-                parts = duration_str.split('h')
-                hours = int(parts[0].strip())
-                if len(parts) > 1 and 'm' in parts[1]:
-                    minutes = int(parts[1].replace('m', '').strip())
+                h, _, m = duration_str.partition('h')
+                hours = int(h.strip())
+                if 'm' in m:
+                    minutes = int(m.replace('m', '').strip())
             elif 'm' in duration_str:
                 minutes = int(duration_str.replace('m', '').strip())
             elif ':' in duration_str:
                 # Handle HH:MM format
-                h, m = duration_str.split(':')
+                h, _, m = duration_str.partition(':')
                 hours = int(h)
                 minutes = int(m)
             else:
@@ -284,23 +320,26 @@ class HealthDataProcessor:
                 minutes = int(float(duration_str))
 
             return round(hours + minutes / 60, 1)
-        except:
+        except (ValueError, TypeError):
+            # Malformed or missing duration
             return 7.5  # Default
 
     def _parse_time(self, time_str: str) -> str:
         """Parse and format time string"""
-        try:
-            # Try to parse various time formats
-            for fmt in ['%H:%M:%S', '%H:%M', '%I:%M %p', '%I:%M:%S %p']:
-                try:
-                    dt = datetime.strptime(time_str, fmt)
-                    return dt.strftime('%H:%M')
-                except:
-                    continue
+        if not isinstance(time_str, str):
             return time_str
-        except:
+
+        match = TIME_PATTERN.fullmatch(time_str)
+        if not match:
             return time_str
 
+        hour, minute, hour12, minute12, meridiem = match.groups()
+        if hour is None:
+            # 12-hour clock: 12 AM is midnight, 12 PM is noon
+            hour = int(hour12) % 12 + (12 if meridiem.upper() == 'PM' else 0)
+            minute = minute12
+        return f"{int(hour):02d}:{int(minute):02d}"
+
     def save_json(self, output_path: str = "health-data.json"):
         """Save processed data to JSON file"""
         # Validate that we have at least some data
@@ -319,8 +358,7 @@ class HealthDataProcessor:
             return False
 
         try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, indent=2)
+            write_json_atomic(output_path, self.data)
             print(f"\n✓ Health data saved to {output_path}")
             print(f"  Last updated: {self.data['lastUpdated']}")
             self.save_diagnostics(success=True)
@@ -336,8 +374,7 @@ class HealthDataProcessor:
         """Save diagnostic information"""
         self.diagnostics['success'] = success
         try:
-            with open('health-data-diagnostics.json', 'w', encoding='utf-8') as f:
-                json.dump(self.diagnostics, f, indent=2)
+            write_json_atomic('health-data-diagnostics.json', self.diagnostics)
             print(f"📊 Diagnostics saved to health-data-diagnostics.json")
         except Exception as e:
             print(f"Warning: Could not save diagnostics: {e}")